@@ -1,13 +1,14 @@
 from bluepy.btle import AssignedNumbers
-from pylsl import StreamInfo, StreamOutlet
+from pylsl import StreamInfo, IRREGULAR_RATE
 
 # pointing to local libs
 import sys, os
 sys.path.insert(0, os.path.join(
     os.path.dirname(os.path.realpath(__file__)), './extern/GattDevice'))
 from gatt_device import GattDevice
+from lsl_buffer import OutletBudget, device_budget, DEFAULT_DEVICE_BUDGET_KB
 
-import struct, argparse, timeit
+import struct, argparse, timeit, collections
 
 # Notice that we might push several IBI at once to LSL output, and effective IBI sampling rate might vary a lot.
 
@@ -21,6 +22,17 @@ DEFAULT_SAMPLINGRATE_IBI = 1
 # how often we show info about sampling rate
 DEFAULT_DEBUG_INTERVAL = 5
 
+# with change-only option, how often (s) we send HR even if unchanged
+DEFAULT_MIN_REFRESH = 5
+
+# IBI units sent by devices (1/1024 s), used as is by compact format, clamped to int16
+IBI_UNITS = 1024
+IBI_INT16_MAX = 32767
+
+# with change-only option, how many IBI pushed we remember to spot those re-sent after a reconnection, and by default how many consecutive values must match before dropping them
+IBI_HISTORY = 32
+DEFAULT_IBI_MIN_OVERLAP = 1
+
 # data format changed between version
 if (sys.version_info > (3, 0)):
     PYTHON_VERSION = 3
@@ -64,6 +76,89 @@ class HRM(GattDevice):
             if args.verbose :
                 print (args.name + " > BPM: " + str(self.hr) + "/ IBI: " + str(self.ibi))
 
+class ChangeFilter():
+    """
+    Suppress redundant values before pushing them to LSL.
+    HR is only sent when it changes, or at least every min_refresh seconds: the refresh fires one notification early so that, even with jitter in arrival, gaps stay below max_gap(). Consumers reconstruct the full series by holding the last value until the next sample, unless it is NaN (sent upon disconnection) or the gap exceeds max_gap(), meaning that data is missing.
+    IBI already pushed are dropped if the device sends them again in the first notification following a reconnection, when at least ibi_min_overlap of them match the last ones pushed. All IBI are kept otherwise. With an overlap of 1 a new beat of the exact same duration (1/1024 s resolution) as the last one pushed before disconnection would be dropped, a rare loss accepted to catch the common re-send of a single IBI.
+    """
+    def __init__(self, min_refresh=DEFAULT_MIN_REFRESH, rate=DEFAULT_SAMPLINGRATE_HR, ibi_min_overlap=DEFAULT_IBI_MIN_OVERLAP):
+        """
+        min_refresh: interval (s) after which HR is sent even if unchanged
+        rate: expected rate of HR notifications (Hz)
+        ibi_min_overlap: minimum number of IBI matching the last ones pushed to drop them after a reconnection
+        """
+        self.min_refresh = min_refresh
+        self.period = 1. / max(1, rate)
+        self.ibi_min_overlap = max(1, ibi_min_overlap)
+        self.last_hr = None
+        self.last_hr_time = 0
+        # last IBI pushed, in raw device units to compare exact values
+        self.last_ibi = collections.deque(maxlen=IBI_HISTORY)
+        # set upon disconnection, the next IBI are checked against the last ones
+        self.resync = False
+
+    def hr(self, value, tick):
+        """
+        Return True if HR value should be pushed at tick (s)
+        """
+        if value != self.last_hr or tick - self.last_hr_time >= self.min_refresh - self.period:
+            self.last_hr = value
+            self.last_hr_time = tick
+            return True
+        return False
+
+    def max_gap(self):
+        """
+        Longest interval (s) between two HR samples while connected, beyond which data is missing. Leaves one notification period for jitter.
+        """
+        return self.min_refresh + self.period
+
+    def ibi(self, values):
+        """
+        Return the list of raw IBI values (1/1024 s) that were not already pushed
+        """
+        if self.resync:
+            self.resync = False
+            # longest beginning of new values that matches the end of the last ones
+            last_ibi = list(self.last_ibi)
+            for overlap in range(min(len(values), len(last_ibi)), self.ibi_min_overlap - 1, -1):
+                if values[:overlap] == last_ibi[-overlap:]:
+                    values = values[overlap:]
+                    break
+        self.last_ibi.extend(values)
+        return values
+
+    def disconnected(self):
+        """
+        To be called when connection is lost, so re-sent IBI are dropped upon reconnection and first HR is always sent
+        """
+        self.resync = True
+        self.last_hr = None
+
+def ibi_raw(ibi):
+    """
+    Convert IBI from seconds back to device units (1/1024 s)
+    """
+    return int(round(ibi * IBI_UNITS))
+
+def encode_ibi(raw, compact):
+    """
+    Value to push for a raw IBI: int16 device units clamped if compact, float seconds otherwise
+    """
+    if compact:
+        return min(raw, IBI_INT16_MAX)
+    return raw / float(IBI_UNITS)
+
+def encoding_desc(info, fields):
+    """
+    Describe in LSL metadata how samples are encoded, for consumers to decode them.
+    fields: dict of string values
+    """
+    encoding = info.desc().append_child("encoding")
+    for key, value in fields.items():
+        encoding.append_child_value(key, str(value))
+
 if __name__=="__main__":
 
     # retrieve MAC address
@@ -77,6 +172,14 @@ if __name__=="__main__":
     parser.add_argument("-k", "--keep_sending", action='store_true', help="If option set, upon disconnection will keep sending the last value until retrieve connectivity with the smartwatch.")
     parser.add_argument("-sr-hr", help="Expected sampling late for HR values. An integer, default: %s" % DEFAULT_SAMPLINGRATE_HR, default=DEFAULT_SAMPLINGRATE_HR, type=int)
     parser.add_argument("-sr-ibi", help="Expected sampling late for IBI values. An integer, default: %s" % DEFAULT_SAMPLINGRATE_IBI, default=DEFAULT_SAMPLINGRATE_IBI, type=int)
+    parser.add_argument("--buffer-kb", help="Memory budget of LSL outlet buffers for this device, in kB. Oldest data is dropped first when consumers stall. Default: %s" % DEFAULT_DEVICE_BUDGET_KB, default=DEFAULT_DEVICE_BUDGET_KB, type=int)
+    parser.add_argument("--fleet-buffer-kb", help="Global memory budget of LSL outlet buffers shared by --fleet-size devices, in kB. The device uses the lowest of this share and --buffer-kb. Default: 0 (disabled)", default=0, type=int)
+    parser.add_argument("--fleet-size", help="Number of devices sharing --fleet-buffer-kb. Default: 1", default=1, type=int)
+    parser.add_argument("--consumers", help="Expected number of LSL inlets per stream, each one getting its own buffer within the budget. Default: 1", default=1, type=int)
+    parser.add_argument("-c", "--change-only", action='store_true', help="Only send HR when it changes (or every --min-refresh seconds), and drop IBI the device sends again after a reconnection. HR stream becomes irregular, hold last value to reconstruct the series, except after NaN (disconnection) or a gap longer than --min-refresh + 1/--sr-hr seconds (max_gap in stream metadata). Last values are not sent while disconnected, whatever --keep_sending.")
+    parser.add_argument("--min-refresh", help="With --change-only, maximum interval (s) between two HR samples. Default: %s" % DEFAULT_MIN_REFRESH, default=DEFAULT_MIN_REFRESH, type=float)
+    parser.add_argument("--ibi-min-overlap", help="With --change-only, how many IBI re-sent after a reconnection must match the last ones sent to be dropped. With 1, a new beat of the exact same duration as the last one may be lost. Default: %s" % DEFAULT_IBI_MIN_OVERLAP, default=DEFAULT_IBI_MIN_OVERLAP, type=int)
+    parser.add_argument("--compact-ibi", action='store_true', help="Send IBI as int16 in device units (1/1024 s) instead of float32 in seconds.")
     args = parser.parse_args()
 
     streaming_hr = (args.streaming == 1 or args.streaming == 3)
@@ -94,35 +197,73 @@ if __name__=="__main__":
     
      # if "reconnect" set, will init the connetion in a separate thread, start streaming dummy values in the meantime
     if hrm.connected or args.reconnect:
+        # outlets share the memory budget of the device, buffers sized upon their rate
+        change_filter = ChangeFilter(args.min_refresh, args.sr_hr, args.ibi_min_overlap)
+
+        budget = OutletBudget(device_budget(args.buffer_kb, args.fleet_buffer_kb, args.fleet_size), args.consumers)
         if streaming_hr :
             print("Streaming HR data")
             type_hr = "heart_rate"
-            info_hr = StreamInfo(args.name, type_hr, 1, args.sr_hr, 'float32', '%s_%s_%s' % (args.name, type_hr, args.mac_address))
-            outlet_hr = StreamOutlet(info_hr)
+            # suppressed values make HR irregular
+            srate_hr = IRREGULAR_RATE if args.change_only else args.sr_hr
+            info_hr = StreamInfo(args.name, type_hr, 1, srate_hr, 'float32', '%s_%s_%s' % (args.name, type_hr, args.mac_address))
+            if args.change_only:
+                encoding_desc(info_hr, {"mode": "change", "reconstruct": "hold", "min_refresh": args.min_refresh, "max_gap": change_filter.max_gap(), "missing": "nan", "unit": "bpm"})
+            budget.add(info_hr, args.sr_hr)
 
         if streaming_ibi :
             print("Streaming IBI data")
             type_ibi = 'heart_ibi'
-            info_ibi = StreamInfo(args.name, type_ibi, 1, args.sr_ibi, 'float32', '%s_%s_%s' % (args.name, type_ibi, args.mac_address))
-            outlet_ibi = StreamOutlet(info_ibi)
+            format_ibi = 'int16' if args.compact_ibi else 'float32'
+            info_ibi = StreamInfo(args.name, type_ibi, 1, args.sr_ibi, format_ibi, '%s_%s_%s' % (args.name, type_ibi, args.mac_address))
+            if args.change_only or args.compact_ibi:
+                encoding_desc(info_ibi, {"mode": "change" if args.change_only else "full", "reconstruct": "none", "unit": "1/%s s" % IBI_UNITS if args.compact_ibi else "s", "scale": 1. / IBI_UNITS if args.compact_ibi else 1})
+            budget.add(info_ibi, args.sr_ibi)
+
+        outlets = budget.create()
+        if streaming_hr :
+            outlet_hr = outlets.pop(0)
+        if streaming_ibi :
+            outlet_ibi = outlets.pop(0)
+        budget.report(args.name)
+        was_connected = hrm.isConnected()
 
         # infinite loop if option set to reconnect automatically, otherwise loop while connected
         while args.reconnect or hrm.isConnected():
             newValHR = hrm.process(1./args.sr_hr) # at least one HR per sample, use this sampling rate
             newValIBI = newValHR and hrm.newIBI # only get new IBI if got new values from Gatt
             
+            connected = hrm.isConnected()
+            if was_connected and not connected:
+                change_filter.disconnected()
+                # tell consumers to stop holding last value
+                if args.change_only and streaming_hr:
+                    outlet_hr.push_sample([float('nan')])
+            was_connected = connected
+
+            # only changes are sent with this option, consumers hold last value in the meantime
+            if args.change_only:
+                if streaming_hr and newValHR and change_filter.hr(hrm.hr, timeit.default_timer()):
+                    outlet_hr.push_sample([hrm.hr])
+
+                if streaming_ibi and newValIBI:
+                    for raw in change_filter.ibi([ibi_raw(ibi) for ibi in hrm.ibi]):
+                        outlet_ibi.push_sample([encode_ibi(raw, args.compact_ibi)])
+
             # depending on option, stream only when get new values, or continuously last value upon reconnect                
-            if streaming_hr and (newValHR or (not hrm.isConnected() and args.keep_sending)):
-                outlet_hr.push_sample([hrm.hr])
-                    
-            if streaming_ibi and (newValIBI or (not hrm.isConnected() and args.keep_sending)):
-                # push all values if got new ones
-                if newValIBI:
-                    for ibi in hrm.ibi:
-                        outlet_ibi.push_sample([ibi])
-                # only last one if disconnected
-                elif not hrm.isConnected() and len(hrm.ibi) > 0:
-                    outlet_ibi.push_sample([hrm.ibi[-1]])
+            else:
+                if streaming_hr and (newValHR or (not connected and args.keep_sending)):
+                    outlet_hr.push_sample([hrm.hr])
+
+                if streaming_ibi and (newValIBI or (not connected and args.keep_sending)):
+                    # push all values if got new ones
+                    if newValIBI:
+                        ibi_values = hrm.ibi
+                    # only last one if disconnected
+                    else:
+                        ibi_values = hrm.ibi[-1:]
+                    for ibi in ibi_values:
+                        outlet_ibi.push_sample([encode_ibi(ibi_raw(ibi), args.compact_ibi)])
 
             # debug info about incoming sampling rate
             if args.verbose:
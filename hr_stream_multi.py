@@ -3,7 +3,8 @@
 # Note: code based on stream_breathing_amp_multi
 import asyncio, argparse, struct, signal, timeit, struct, sys
 from bleak import BleakClient
-from pylsl import StreamInfo, StreamOutlet
+from pylsl import StreamInfo
+from lsl_buffer import OutletBudget, device_budget, DEFAULT_DEVICE_BUDGET_KB
 
 # long UUID for standard HR characteristic
 CHARACTERISTIC_UUID_HR = "00002a37-0000-1000-8000-00805f9b34fb"
@@ -162,6 +163,10 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--verbose", action='store_true', help="Print more verbose information.")
     parser.add_argument("-sr-hr", help="Expected sampling late for HR values. An integer, default: %s" % DEFAULT_SAMPLINGRATE_HR, default=DEFAULT_SAMPLINGRATE_HR, type=int)
     parser.add_argument("-sr-ibi", help="Expected sampling late for IBI values. An integer, default: %s" % DEFAULT_SAMPLINGRATE_IBI, default=DEFAULT_SAMPLINGRATE_IBI, type=int)
+    parser.add_argument("--buffer-kb", help="Memory budget of LSL outlet buffers for this device, in kB. Oldest data is dropped first when consumers stall. Default: %s" % DEFAULT_DEVICE_BUDGET_KB, default=DEFAULT_DEVICE_BUDGET_KB, type=int)
+    parser.add_argument("--fleet-buffer-kb", help="Global memory budget of LSL outlet buffers shared by --fleet-size devices, in kB. The device uses the lowest of this share and --buffer-kb. Default: 0 (disabled)", default=0, type=int)
+    parser.add_argument("--fleet-size", help="Number of devices sharing --fleet-buffer-kb. Default: 1", default=1, type=int)
+    parser.add_argument("--consumers", help="Expected number of LSL inlets per stream, each one getting its own buffer within the budget. Default: 1", default=1, type=int)
     args = parser.parse_args()
 
     parser.set_defaults()
@@ -172,17 +177,26 @@ if __name__ == "__main__":
     streaming_ibi = (args.streaming == 2 or args.streaming == 3)
     outlet_hr = None
     outlet_ibi = None
+    # outlets share the memory budget of the device, buffers sized upon their rate
+    budget = OutletBudget(device_budget(args.buffer_kb, args.fleet_buffer_kb, args.fleet_size), args.consumers)
     if streaming_hr :
         print("Streaming HR data")
         type_hr = "heart_rate"
         info_hr = StreamInfo(args.name, type_hr, 1, args.sr_hr, 'float32', '%s_%s_%s' % (args.name, type_hr, args.mac_address))
-        outlet_hr = StreamOutlet(info_hr)
+        budget.add(info_hr, args.sr_hr)
 
     if streaming_ibi :
         print("Streaming IBI data")
         type_ibi = 'heart_ibi'
         info_ibi = StreamInfo(args.name, type_ibi, 1, args.sr_ibi, 'float32', '%s_%s_%s' % (args.name, type_ibi, args.mac_address))
-        outlet_ibi = StreamOutlet(info_ibi)
+        budget.add(info_ibi, args.sr_ibi)
+
+    outlets = budget.create()
+    if streaming_hr :
+        outlet_hr = outlets.pop(0)
+    if streaming_ibi :
+        outlet_ibi = outlets.pop(0)
+    budget.report(args.name)
 
     
     def stream(data):
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Shared helpers to create LSL outlets with an explicit memory budget, instead of relying on liblsl defaults (chunk_size=0, max_buffered=360s), which let a stalled consumer make each outlet queue minutes of data.
+# When an outlet buffer is full liblsl drops the oldest samples first, so the budget is a ceiling on memory, at the cost of losing old data for late consumers.
+# Note that liblsl keeps one queue per connected inlet, hence the budget is split between the expected number of consumers.
+
+from pylsl import StreamOutlet, cf_float32, cf_double64, cf_int8, cf_int16, cf_int32, cf_int64
+
+# default memory budget for all outlets of one device (kB)
+DEFAULT_DEVICE_BUDGET_KB = 16
+
+# never buffer more than liblsl default (s), even if the budget allows it
+MAX_DURATION = 360
+
+# bytes used by one value of each LSL channel format
+FORMAT_SIZE = {
+    cf_float32: 4,
+    cf_double64: 8,
+    cf_int8: 1,
+    cf_int16: 2,
+    cf_int32: 4,
+    cf_int64: 8,
+}
+
+# rough estimate of liblsl bookkeeping per buffered sample (timestamp, refcount, pointers...)
+SAMPLE_OVERHEAD = 48
+
+# target chunk duration (s) for outlets, small to keep latency low with our slow streams
+CHUNK_DURATION = 1
+
+def device_budget(device_kb, fleet_kb=0, fleet_size=1):
+    """
+    Return the memory budget of one device in bytes.
+    device_kb: per-device budget (kB)
+    fleet_kb: global budget (kB) shared evenly by all devices of the fleet, 0 to disable
+    fleet_size: number of devices sharing fleet_kb
+    """
+    budget = device_kb * 1024
+    if fleet_kb > 0:
+        budget = min(budget, fleet_kb * 1024 // max(1, fleet_size))
+    return budget
+
+def sample_size(channel_format, channel_count=1):
+    """
+    Estimated memory (bytes) taken by one sample in an outlet buffer
+    channel_format: pylsl cf_* constant, as returned by StreamInfo.channel_format()
+    """
+    return FORMAT_SIZE[channel_format] * channel_count + SAMPLE_OVERHEAD
+
+class OutletBudget():
+    """
+    Split a device budget between its outlets and their consumers. All outlets get the same buffer duration, computed from their nominal rate and format, so that they all hold the same time span of data.
+    """
+    def __init__(self, budget, consumers=1):
+        """
+        budget: memory budget of the device, in bytes
+        consumers: expected number of inlets connected to each outlet, each one getting its own queue
+        """
+        self.budget = budget
+        self.consumers = max(1, consumers)
+        # list of (info, rate, size) to be created
+        self.streams = []
+        # bytes reserved per outlet and per consumer, filled upon create()
+        self.usage = {}
+
+    def add(self, info, rate):
+        """
+        Register a stream that will share the budget.
+        info: pylsl StreamInfo
+        rate: expected rate of samples (Hz), used for irregular streams as well
+        """
+        self.streams.append((info, max(1, rate), sample_size(info.channel_format(), info.channel_count())))
+
+    def duration(self):
+        """
+        Buffer duration (s) of each outlet so that all fit in budget, between 1s and MAX_DURATION
+        """
+        bytes_per_second = sum(rate * size for _, rate, size in self.streams) * self.consumers
+        if bytes_per_second <= 0:
+            return MAX_DURATION
+        return min(MAX_DURATION, max(1, int(self.budget // bytes_per_second)))
+
+    def create(self):
+        """
+        Create outlets for registered streams, returns them in the same order.
+        """
+        duration = self.duration()
+        outlets = []
+        self.usage = {}
+        for info, rate, size in self.streams:
+            chunk_size = max(1, int(rate * CHUNK_DURATION))
+            # for irregular streams liblsl counts max_buffered in hundreds of samples instead of seconds
+            if info.nominal_srate() > 0:
+                max_buffered = duration
+                buffered_samples = rate * max_buffered
+            else:
+                max_buffered = max(1, int(rate * duration) // 100)
+                buffered_samples = max_buffered * 100
+            outlets.append(StreamOutlet(info, chunk_size=chunk_size, max_buffered=max_buffered))
+            self.usage[info.type()] = buffered_samples * size
+        return outlets
+
+    def total(self):
+        """
+        Memory ceiling (bytes) of the device, for all expected consumers
+        """
+        return sum(self.usage.values()) * self.consumers
+
+    def report(self, name):
+        """
+        Print memory ceiling of the device, per outlet, and warn if it exceeds the budget. This is what outlets may hold at most, liblsl does not tell how much is actually queued.
+        """
+        details = ", ".join("%s: %.1f kB" % (stream_type, used / 1024.) for stream_type, used in self.usage.items())
+        print("%s > outlet buffers hold %ss of data, at most %.1f kB per consumer (%s), %.1f kB for %s consumer(s) out of %.1f kB budget" % (name, self.duration(), sum(self.usage.values()) / 1024., details, self.total() / 1024., self.consumers, self.budget / 1024.))
+        if self.total() > self.budget:
+            print("%s > WARNING: budget too low for these sampling rates, outlet buffers may use up to %.1f kB" % (name, self.total() / 1024.))